@@ -1,8 +1,17 @@
-import json
+import concurrent.futures
+import functools
+import hashlib
+import itertools
 import logging
-from datetime import datetime, timedelta
+import operator
+import os
+import stat
+import time
+from datetime import date
 from pathlib import Path
 
+import msgpack
+import orjson
 from dotenv import dotenv_values
 from mastodon import Mastodon
 from rich.console import Console
@@ -19,49 +28,114 @@ SUSPENDED_TABLE_COLUMNS = [
     ("follower", "blue"),
     ("following", "blue"),
 ]
+COLUMN_KEYS = tuple(column for column, _ in SUSPENDED_TABLE_COLUMNS)
+_ROW_GETTER = operator.itemgetter(*COLUMN_KEYS)
+
+# where to keep cache files
+CACHE_DIR = Path(".cache")
+
 # how long to hold onto cache files
-CACHE_LIFESPAN = timedelta(hours=1)
+CACHE_LIFESPAN_SECS = 3600.0
+
+# how each cache format is named, read, and written
+CACHE_FORMATS = {
+    "json": (
+        ".json",
+        orjson.loads,
+        lambda data: orjson.dumps(data, option=orjson.OPT_INDENT_2),
+    ),
+    "msgpack": (
+        ".msgpack",
+        lambda raw: msgpack.unpackb(raw, raw=False),
+        lambda data: msgpack.packb(data, use_bin_type=True),
+    ),
+}
+
+
+def cache_key(func_name, args, kwargs):
+    """
+    Return a short hash identifying one call of a stored function.
 
-# When did this script start running?
-NOW = datetime.now()
+    A Mastodon client stands in as its instance URL and access token, so
+    different users or instances don't share cache files.
+    """
+    call_args = tuple(
+        (arg.api_base_url, arg.access_token) if isinstance(arg, Mastodon) else arg
+        for arg in args
+    )
+    material = repr((func_name, call_args, sorted(kwargs.items())))
 
-logging.basicConfig(level="INFO", format="%(message)s", handlers=[RichHandler()])
+    return hashlib.blake2b(material.encode(), digest_size=8).hexdigest()
 
 
-def stored(func):
+def stored(func=None, *, cache_format="json"):
     """
     Utilize a file cache for the decorated function.
 
-    - if the cache exists and is younger than ``CACHE_LIFESPAN``, use it
+    - cache files live in ``CACHE_DIR``, one per distinct set of arguments
+    - if the cache exists and is younger than ``CACHE_LIFESPAN_SECS``, use it
     - otherwise, call the function and store the result
+
+    ``cache_format`` picks an entry from ``CACHE_FORMATS``. JSON is easy to
+    read and share; MessagePack is smaller and quicker to load.
     """
+    if func is None:
+        return functools.partial(stored, cache_format=cache_format)
+
+    suffix, load, dump = CACHE_FORMATS[cache_format]
 
     def inner(*args, **kwargs):
         func_name = func.__name__
         logging.debug("stored.inner for %s", func_name)
-        cache_file = Path(f"{func_name}.json")
+        key = cache_key(func_name, args, kwargs)
+        cache_file = CACHE_DIR / f"{func_name}-{key}{suffix}"
+
+        try:
+            st = os.stat(cache_file)
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
 
-        if cache_file.is_file():
-            logging.debug("Cache file %s exists", cache_file)
-            cache_written_at = datetime.fromtimestamp(cache_file.stat().st_mtime)
-            logging.debug("Cache file written at %s", cache_written_at)
+        if st and stat.S_ISREG(st.st_mode):
+            logging.debug("Cache file %s written at %s", cache_file, st.st_mtime)
 
-            if NOW - cache_written_at < CACHE_LIFESPAN:
+            if time.time() - st.st_mtime < CACHE_LIFESPAN_SECS:
                 logging.info("Loading data from %s", cache_file)
-                data = json.loads(cache_file.read_text(encoding="utf-8"))
+                data = load(cache_file.read_bytes())
                 return data
 
         logging.info("Calling %s", func_name)
         data = func(*args, **kwargs)
 
         logging.info("Writing data to %s", cache_file)
-        cache_file.write_text(json.dumps(data, indent=4, default=str), encoding="utf-8")
+        CACHE_DIR.mkdir(exist_ok=True)
+        # write beside the cache file so the replace is atomic
+        tmp_file = cache_file.with_suffix(cache_file.suffix + ".tmp")
+        tmp_file.write_bytes(dump(data))
+        os.replace(tmp_file, cache_file)
 
         return data
 
     return inner
 
 
+def plain(value):
+    """
+    Return a copy of API response data with dates and datetimes as strings.
+
+    Done once after fetching so the cache serializers only see native types.
+    """
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+
+    if isinstance(value, date):
+        return str(value)
+
+    return value
+
+
 @stored
 def instance_summary(mastodon: Mastodon):
     """Return a dictionary of information about the connected instance."""
@@ -76,106 +150,121 @@ def instance_summary(mastodon: Mastodon):
 @stored
 def my_info(mastodon: Mastodon):
     """Return a dictionary of information about the logged in user."""
-    return mastodon.me()
+    return plain(mastodon.me())
 
 
-@stored
-def following(mastodon: Mastodon, user_id: int):
-    """Fetches and returns a list of users a given user is following."""
-    accounts = mastodon.account_following(user_id)
-    accounts = mastodon.fetch_remaining(accounts)
+def iter_accounts(mastodon: Mastodon, page):
+    """Yield accounts from ``page`` and each page after it."""
+    while page:
+        yield from page
+        page = mastodon.fetch_next(page)
 
-    return accounts
 
+def contact_summary(accounts):
+    """
+    Reduce a stream of accounts to what the suspension check needs.
 
-@stored
-def followers(mastodon: Mastodon, user_id: int):
-    """Fetches and returns a list of followers for the given user."""
-    accounts = mastodon.account_followers(user_id)
-    accounts = mastodon.fetch_remaining(accounts)
+    That's every handle, for counting, plus the full record of any account
+    marked as suspended.
+    """
+    handles = []
+    suspended = []
 
-    return accounts
+    for account in accounts:
+        handles.append(account["acct"])
 
+        if account.get("suspended"):
+            suspended.append(plain(account))
 
-@stored
-def my_suspended_acquaintances(followers, following):
-    """
-    Identify known accounts that have some relation to me.
+    return {"handles": handles, "suspended": suspended}
 
-    Relation is either: they follow me or I follow them.
-    """
-    related_accounts = {}
 
-    for account in followers:
-        handle = account["acct"]
+@stored(cache_format="msgpack")
+def following(mastodon: Mastodon, user_id: int):
+    """Summarize the users a given user is following."""
+    page = mastodon.account_following(user_id)
 
-        if handle not in related_accounts:
-            related_accounts[handle] = account
-            related_accounts[handle]["following"] = False
+    return contact_summary(iter_accounts(mastodon, page))
 
-        related_accounts[handle]["follower"] = True
 
-    for account in following:
-        handle = account["acct"]
+@stored(cache_format="msgpack")
+def followers(mastodon: Mastodon, user_id: int):
+    """Summarize the followers of the given user."""
+    page = mastodon.account_followers(user_id)
+
+    return contact_summary(iter_accounts(mastodon, page))
 
-        if handle not in related_accounts:
-            related_accounts[handle] = account
-            related_accounts[handle]["follower"] = False
 
-        related_accounts[handle]["following"] = True
+@stored
+def my_suspended_acquaintances(followers, following):
+    """
+    Identify known accounts that have some relation to me.
 
+    Relation is either: they follow me or I follow them. Both arguments
+    are summaries from ``contact_summary``.
+    """
+    follower_handles = set(followers["handles"])
+    following_handles = set(following["handles"])
+    by_handle = {
+        account["acct"]: account
+        for account in itertools.chain(followers["suspended"], following["suspended"])
+    }
     suspended_accounts = [
-        account
-        for handle, account in related_accounts.items()
-        if account.get("suspended")
+        {
+            **account,
+            "follower": handle in follower_handles,
+            "following": handle in following_handles,
+        }
+        for handle, account in by_handle.items()
     ]
     suspended_accounts.sort(key=lambda account: account["acct"])
 
     return suspended_accounts
 
 
-@stored
 def suspended_table_rows(accounts):
-    """Filter accounts to columns used for table summary."""
-    return [
-        {column: row[column] for column, _ in SUSPENDED_TABLE_COLUMNS}
-        for row in accounts
-    ]
+    """Filter accounts to the values of columns used for table summary."""
+    return [_ROW_GETTER(row) for row in accounts]
 
 
 def accounts_table(accounts):
     """Return a Rich table summary of provided accounts."""
-    logging.debug(accounts[0].keys())
+    if accounts and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("columns: %s", list(accounts[0].keys()))
+
     table = Table(show_footer=True)
     table.add_column("row", "row", style="bold green")
 
     for column_name, style in SUSPENDED_TABLE_COLUMNS:
         table.add_column(column_name, column_name, style=style)
 
-    # cache more for information sharing than for optimization
     account_rows = suspended_table_rows(accounts)
-    row_index = 0
 
-    for account in account_rows:
-        row_index += 1
-        values = [str(account.get(column)) for column, _ in SUSPENDED_TABLE_COLUMNS]
-        table.add_row(str(row_index), *values)
+    for row_index, row in enumerate(account_rows, start=1):
+        table.add_row(str(row_index), *map(str, row))
 
     return table
 
 
 def main():
     """Print accounts connected to me that are labeled as suspended."""
+    logging.basicConfig(level="INFO", format="%(message)s", handlers=[RichHandler()])
     config = dotenv_values(ENV_FILE)
-    logging.info(config)
+    logging.debug("loaded %d env keys", len(config))
     mastodon = Mastodon(**config)
     logging.debug(instance_summary(mastodon))
     this_user = my_info(mastodon)
     logging.debug(this_user)
-    followers_me = followers(mastodon, this_user["id"])
-    logging.info("%s followers", len(followers_me))
-    following_me = following(mastodon, this_user["id"])
-    logging.info("%s following", len(following_me))
+
+    # both are paginated network calls writing separate cache files
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        followers_future = executor.submit(followers, mastodon, this_user["id"])
+        following_future = executor.submit(following, mastodon, this_user["id"])
+        followers_me = followers_future.result()
+        following_me = following_future.result()
+
+    logging.info("%s followers", len(followers_me["handles"]))
+    logging.info("%s following", len(following_me["handles"]))
     logging.debug(followers_me)
     logging.debug(following_me)
 